@@ -3,16 +3,25 @@ LP BYGG AS – Tool Inventory (Flask)
 Branding + CSV/Excel + QR scan + Events + Backup/Restore (Windows-safe)
 Debug on (no reloader) for local diagnostics; Render-ready; supports persistent storage via DATA_DIR/UPLOAD_DIR/DB_PATH.
 """
-import os, io, csv, zipfile, tempfile, shutil, sqlite3
+import os, io, re, csv, mimetypes, zipfile, tempfile, shutil, sqlite3, hashlib, hmac, time
+from contextlib import closing
 from datetime import datetime
 from pathlib import Path
-from werkzeug.utils import secure_filename
 
-from flask import Flask, request, redirect, url_for, render_template, send_from_directory, session, jsonify, flash, send_file
+from flask import Flask, Request, Response, request, stream_with_context, abort, redirect, url_for, render_template, send_from_directory, session, flash, send_file
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import or_
-from jinja2 import DictLoader
+from flask_compress import Compress
+from flask_caching import Cache
+from werkzeug.security import safe_join
+import orjson
+from sqlalchemy import event as sa_event, func, or_, tuple_, select, update, insert, text, table, column
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.orm import load_only, raiseload
+from jinja2 import DictLoader, FileSystemBytecodeCache
 from openpyxl import Workbook
+from PIL import Image, ImageOps
 
 # ----- Paths / storage -----
 BASE_DIR = Path(__file__).resolve().parent
@@ -21,13 +30,113 @@ UPLOAD_DIR = Path(os.environ.get("UPLOAD_DIR", DATA_DIR / "uploads"))
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 DB_PATH = Path(os.environ.get("DB_PATH", DATA_DIR / "inventory.db"))
 
+class ORJSONProvider(DefaultJSONProvider):
+    """app.json backed by orjson; Flask's default() still covers Decimal, UUID, dataclasses."""
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__, static_folder="static")
+app.json = ORJSONProvider(app)
 app.config.update(
     SECRET_KEY=os.environ.get("SECRET_KEY", "dev-secret-change-me"),
     SQLALCHEMY_DATABASE_URI=f"sqlite:///{DB_PATH}",
     SQLALCHEMY_TRACK_MODIFICATIONS=False,
+    # SQLAlchemy 2 already pools file-backed SQLite connections (QueuePool); wait for a
+    # busy writer instead of failing with "database is locked"
+    SQLALCHEMY_ENGINE_OPTIONS={"connect_args": {"timeout": 10}},
     MAX_CONTENT_LENGTH=50 * 1024 * 1024,
+    # behind nginx/Apache with X-Sendfile support, let the front-end stream upload files
+    USE_X_SENDFILE=os.environ.get("USE_X_SENDFILE") == "1",
+    # behind nginx: internal location aliased to UPLOAD_DIR, e.g. "/_internal_uploads/"
+    XACCEL_UPLOADS_PREFIX=os.environ.get("XACCEL_UPLOADS_PREFIX", ""),
+    COMPRESS_ALGORITHM=["br", "gzip"],
+    # streamed responses (/api/tools) pick from this list; Flask-Compress's default lacks gzip
+    COMPRESS_ALGORITHM_STREAMING=["br", "gzip"],
+    COMPRESS_MIN_SIZE=512,
+    COMPRESS_LEVEL=5,
+    # templates live in DictLoader strings and never change at runtime
+    TEMPLATES_AUTO_RELOAD=False,
+    CACHE_TYPE=os.environ.get("CACHE_TYPE", "SimpleCache"),
 )
+Compress(app)
+cache = Cache(app)
+
+# ----- Uploads: spool small files in memory, store photos as downscaled WebP -----
+UPLOAD_SPOOL_SIZE = 2 * 1024 * 1024
+PHOTO_MAX_SIZE = (800, 800)
+PHOTO_THUMB_SIZE = (320, 320)  # card grid on the index page
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE, mode="rb+")
+
+app.request_class = UploadRequest
+
+def write_once(path, data):
+    """Create `path` with `data` unless it already exists (content-derived names never change)."""
+    path.parent.mkdir(exist_ok=True)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o644)
+    except FileExistsError:
+        return  # same bytes already stored
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+    except BaseException:
+        path.unlink(missing_ok=True)  # never leave a truncated file under a content hash
+        raise
+
+def store_upload(data, ext):
+    """Store bytes under their content hash (UPLOAD_DIR/ab/cdef….ext) and return the relative path.
+
+    Names are content-addressed, so a stored file never changes and can be cached forever.
+    """
+    h = hashlib.blake2b(data, digest_size=8).hexdigest()
+    rel = f"{h[:2]}/{h[2:]}.{ext}"
+    write_once(UPLOAD_DIR / rel, data)
+    return rel
+
+def thumb_name(rel):
+    return rel[:-len(".webp")] + "_thumb.webp"
+
+def encode_webp(im):
+    buf = io.BytesIO()
+    im.save(buf, 'WEBP', quality=80, method=4)
+    return buf.getvalue()
+
+def store_photo(stream):
+    """Downscale an uploaded photo to PHOTO_MAX_SIZE, encode as WebP and store it with a card-size thumbnail.
+
+    Returns the path relative to UPLOAD_DIR, or None if the upload is not a readable image.
+    """
+    try:
+        im = ImageOps.exif_transpose(Image.open(stream))
+        im.thumbnail(PHOTO_MAX_SIZE)
+    except (OSError, Image.DecompressionBombError):
+        return None
+    if im.mode not in ("RGB", "RGBA"):
+        im = im.convert("RGBA" if im.has_transparency_data else "RGB")
+    rel = store_upload(encode_webp(im), 'webp')
+    im.thumbnail(PHOTO_THUMB_SIZE)
+    write_once(UPLOAD_DIR / thumb_name(rel), encode_webp(im))
+    return rel
+
+_PHOTO_URL_RE = re.compile(r"^/uploads/[0-9a-f]{2}/[0-9a-f]+\.webp$")
+
+@app.template_filter('thumb')
+def photo_thumb(photo_path):
+    # photos stored before thumbnails existed have none; show the full image for those
+    if _PHOTO_URL_RE.match(photo_path or ""):
+        return thumb_name(photo_path)
+    return photo_path
 
 db = SQLAlchemy(app)
 
@@ -42,6 +151,16 @@ class Tool(db.Model):
     holder = db.Column(db.String(120), default="")
     checkout_date = db.Column(db.String(10), default="")
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # lazy='raise': history must be queried explicitly, never loaded by accident
+    events = db.relationship('Event', back_populates='tool', lazy='raise', order_by='Event.when.desc()')
+
+    __table_args__ = (
+        # one index per filter combination of index(), each in keyset order (newest first, id breaks ties)
+        db.Index('ix_tool_cat_holder_created', category, holder, created_at.desc(), id.desc()),
+        db.Index('ix_tool_cat_created', category, created_at.desc(), id.desc()),
+        db.Index('ix_tool_holder_created', holder, created_at.desc(), id.desc()),
+        db.Index('ix_tool_created_at', created_at.desc(), id.desc()),
+    )
 
 class Event(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -50,13 +169,217 @@ class Event(db.Model):
     person = db.Column(db.String(120), default="")
     when = db.Column(db.DateTime, default=datetime.utcnow)
     note = db.Column(db.Text, default="")
+    tool = db.relationship('Tool', back_populates='events', lazy='raise')
 
-with app.app_context():
+    __table_args__ = (
+        db.Index('ix_event_tool_when', tool_id, when.desc()),  # per-tool history, newest first
+        db.Index('ix_event_when', when.desc(), id.desc()),  # /events listing, keyset order
+    )
+
+# ----- Full-text search (SQLite FTS5, external content = tool table) -----
+# tool_fts: word-prefix search over name/description/serial_no;
+# tool_serial_fts: trigram index, so any 3+ character part of a serial number matches
+tool_fts = table('tool_fts', column('rowid'), column('tool_fts'))
+tool_serial_fts = table('tool_serial_fts', column('rowid'), column('tool_serial_fts'))
+
+SEARCH_TABLES = {
+    'tool_fts': "CREATE VIRTUAL TABLE tool_fts USING fts5("
+                "name, description, serial_no, content='tool', content_rowid='id')",
+    'tool_serial_fts': "CREATE VIRTUAL TABLE tool_serial_fts USING fts5("
+                       "serial_no, content='tool', content_rowid='id', tokenize='trigram')",
+}
+
+TOOL_FTS_TRIGGERS = {
+    'tool_fts_ai': """CREATE TRIGGER tool_fts_ai AFTER INSERT ON tool BEGIN
+         INSERT INTO tool_fts(rowid, name, description, serial_no) VALUES (new.id, new.name, new.description, new.serial_no);
+         INSERT INTO tool_serial_fts(rowid, serial_no) VALUES (new.id, new.serial_no);
+       END""",
+    'tool_fts_ad': """CREATE TRIGGER tool_fts_ad AFTER DELETE ON tool BEGIN
+         INSERT INTO tool_fts(tool_fts, rowid, name, description, serial_no) VALUES ('delete', old.id, old.name, old.description, old.serial_no);
+         INSERT INTO tool_serial_fts(tool_serial_fts, rowid, serial_no) VALUES ('delete', old.id, old.serial_no);
+       END""",
+    # only the indexed columns: checkout/return updates must not touch the FTS index
+    'tool_fts_au': """CREATE TRIGGER tool_fts_au AFTER UPDATE OF name, description, serial_no ON tool BEGIN
+         INSERT INTO tool_fts(tool_fts, rowid, name, description, serial_no) VALUES ('delete', old.id, old.name, old.description, old.serial_no);
+         INSERT INTO tool_fts(rowid, name, description, serial_no) VALUES (new.id, new.name, new.description, new.serial_no);
+         INSERT INTO tool_serial_fts(tool_serial_fts, rowid, serial_no) VALUES ('delete', old.id, old.serial_no);
+         INSERT INTO tool_serial_fts(rowid, serial_no) VALUES (new.id, new.serial_no);
+       END""",
+}
+
+def ensure_search_index():
+    """Create (and fill) the FTS5 indexes; fall back to LIKE search if SQLite lacks FTS5 or trigrams (< 3.34)."""
+    try:
+        existing = set(db.session.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'")).scalars())
+        for name, ddl in SEARCH_TABLES.items():
+            if name not in existing:
+                db.session.execute(text(ddl))
+                db.session.execute(text(f"INSERT INTO {name}({name}) VALUES ('rebuild')"))
+        # recreated every time, so databases from before tool_serial_fts get the current trigger bodies
+        for name, ddl in TOOL_FTS_TRIGGERS.items():
+            db.session.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+            db.session.execute(text(ddl))
+        db.session.commit()
+        app.config['SEARCH_FTS'] = True
+    except OperationalError:
+        db.session.rollback()
+        app.logger.warning("SQLite FTS5 unavailable, search falls back to LIKE")
+        app.config['SEARCH_FTS'] = False
+
+def fts_query(q):
+    """Free text -> FTS5 query: every word, quoted, must prefix-match a token."""
+    return " ".join('"%s"*' % w.replace('"', '""') for w in q.split())
+
+def search_ids(q):
+    """Ids of tools matching q: word prefixes anywhere, or q as a substring of the serial number."""
+    ids = select(tool_fts.c.rowid).where(tool_fts.c.tool_fts.match(fts_query(q)))
+    if len(q) >= 3:  # trigrams cannot answer shorter substrings
+        ids = ids.union(select(tool_serial_fts.c.rowid)
+                        .where(tool_serial_fts.c.tool_serial_fts.match('"%s"' % q.replace('"', '""'))))
+    return ids
+
+def ensure_schema():
+    """Create missing tables and indexes, rebuilding indexes whose definition changed.
+
+    create_all skips indexes of existing tables, and a name check alone would keep an outdated index.
+    """
     db.create_all()
+    with db.engine.begin() as conn:
+        existing = dict(conn.execute(text("SELECT name, sql FROM sqlite_master WHERE type = 'index'")).all())
+        for tbl in db.metadata.sorted_tables:
+            for index in tbl.indexes:
+                ddl = str(CreateIndex(index).compile(conn)).strip()
+                if existing.get(index.name) == ddl:
+                    continue
+                if index.name in existing:
+                    index.drop(conn)
+                index.create(conn)
+    ensure_search_index()
+
+def set_sqlite_pragma(dbapi_conn, conn_record):
+    # WAL lets the list pages read while a checkout/edit is committing
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA cache_size=-20000")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.close()
+
+with app.app_context():
+    sa_event.listen(db.engine, "connect", set_sqlite_pragma)
+    ensure_schema()
 
-ALLOWED_EXT = {"png", "jpg", "jpeg", "gif", "webp"}
+_EXT_RE = re.compile(r"\.(png|jpe?g|gif|webp)$", re.I)
 def allowed_file(filename: str):
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXT
+    return bool(_EXT_RE.search(filename or ""))
+
+def save_photo(photo_file):
+    """Store an uploaded photo from a form; return its /uploads URL, or None if there is nothing to store."""
+    if not (photo_file and allowed_file(photo_file.filename)):
+        return None
+    fname = store_photo(photo_file.stream)
+    if not fname:
+        flash('Nie udało się odczytać zdjęcia.', 'warning')
+        return None
+    return f"/uploads/{fname}"
+
+# ----- Per-process caches, dropped by every write route -----
+# TTL bounds staleness when another worker process did the write
+FACET_TTL = 60
+_facet_cache = {'data': None, 't': 0.0}
+
+def get_facets():
+    """(categories, holders) for the index filter dropdowns."""
+    data = _facet_cache['data']
+    if data is None or time.monotonic() - _facet_cache['t'] > FACET_TTL:
+        # one pass over (category, holder) pairs instead of two SELECT DISTINCT scans
+        cats, holders = {}, {}
+        for c, h in db.session.query(Tool.category, Tool.holder).distinct():
+            if c: cats[c] = None
+            if h: holders[h] = None
+        data = _facet_cache['data'] = (list(cats), list(holders))
+        _facet_cache['t'] = time.monotonic()
+    return data
+
+def invalidate_caches():
+    _facet_cache['data'] = None
+    cache.cache.inc('data_version')  # retires every cached page at once
+
+def page_cache_key(*args, **kwargs):
+    """Cached pages are keyed by path + query string + data version."""
+    return f"page/{cache.get('data_version') or 0}{request.full_path}"
+
+def cache_page(func):
+    """Cache a rendered list page until the next write (at most 30 s)."""
+    # pages carrying flash messages are one-off and must not be served to anyone else
+    return cache.cached(timeout=30, make_cache_key=page_cache_key, unless=lambda: '_flashes' in session)(func)
+
+_today_cache = [-1, ""]
+
+def today_str():
+    """Today's UTC date as YYYY-MM-DD, formatted once per day."""
+    day = int(time.time() // 86400)  # the UTC date changes exactly at these boundaries
+    if day != _today_cache[0]:
+        _today_cache[1] = datetime.utcfromtimestamp(day * 86400).strftime('%Y-%m-%d')
+        _today_cache[0] = day
+    return _today_cache[1]
+
+def parse_cursor(value):
+    """Parse a '<timestamp>~<id>' paging cursor into (datetime or None, id or None).
+
+    A bare timestamp is accepted too. Raises ValueError on anything else, so request.args.get(type=...)
+    ignores a malformed cursor.
+    """
+    ts, sep, row_id = value.rpartition('~')
+    if not sep:
+        return datetime.fromisoformat(value), None
+    return (datetime.fromisoformat(ts) if ts else None), int(row_id)
+
+def make_cursor(ts, row_id):
+    return f"{ts.isoformat() if ts else ''}~{row_id}"
+
+def keyset_selects(stmt, ts_col, id_col, cursor=None):
+    """Split a newest-first listing into the statements to run, in order, for the rows after `cursor`.
+
+    Rows with a timestamp come first, then (as SQLite sorts NULLs last) the rows without one. Each
+    statement is a single range over a (ts DESC, id DESC) index: a row-value comparison instead of
+    an OR of ranges, which would need a temp B-tree for the ORDER BY.
+    """
+    ts, row_id = cursor or (None, None)
+    undated = stmt.where(ts_col.is_(None)).order_by(id_col.desc())
+    if cursor and ts is None:  # already in the undated tail
+        return [undated.where(id_col < row_id)]
+    dated = stmt.where(ts_col.is_not(None))
+    if ts is not None:
+        dated = dated.where(ts_col < ts if row_id is None else tuple_(ts_col, id_col) < tuple_(ts, row_id))
+    return [dated.order_by(ts_col.desc(), id_col.desc()), undated]
+
+def fetch_rows(stmts, limit):
+    """Run keyset_selects() statements until `limit` rows are collected."""
+    rows = []
+    for stmt in stmts:
+        if len(rows) >= limit:
+            break
+        rows += db.session.execute(stmt.limit(limit - len(rows))).all()
+    return rows
+
+def keyset_page(rows, per_page, key, keep=()):
+    """Trim rows fetched with LIMIT per_page + 1 and build the pager links.
+
+    Returns (rows, first_url, next_url); the links carry the filter args named in `keep` and are
+    None when already on the first / last page.
+    """
+    # only known filters: anything else would reach url_for() as its own keyword arguments
+    args = {k: request.args[k] for k in keep if request.args.get(k)}
+    first_url = None
+    if request.args.get('cursor'):
+        first_url = url_for(request.endpoint, **args)
+    next_url = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_url = url_for(request.endpoint, **args, cursor=make_cursor(getattr(last, key), last.id))
+    return rows, first_url, next_url
 
 def require_login(func):
     from functools import wraps
@@ -70,16 +393,29 @@ def require_login(func):
 # ----- Static uploads -----
 @app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(UPLOAD_DIR, filename)
+    prefix = app.config["XACCEL_UPLOADS_PREFIX"]
+    if prefix:
+        # nginx reads and sends the file; the worker only answers with headers
+        if safe_join(str(UPLOAD_DIR), filename) is None:
+            abort(404)
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+        response.headers["X-Accel-Redirect"] = f"{prefix.rstrip('/')}/{filename}"
+        response.cache_control.max_age = 31536000
+    else:
+        response = send_from_directory(UPLOAD_DIR, filename, conditional=True, max_age=31536000)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 # ----- Auth -----
+ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'admin').encode()
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     err = None
     if request.method == 'POST':
         pwd = request.form.get('password', '')
-        admin_pwd = os.environ.get('ADMIN_PASSWORD', 'admin')
-        if pwd == admin_pwd:
+        if hmac.compare_digest(pwd.encode(), ADMIN_PASSWORD):
             session['logged_in'] = True
             return redirect(request.args.get('next') or url_for('index'))
         err = 'Nieprawidłowe hasło.'
@@ -91,26 +427,41 @@ def logout():
     return redirect(url_for('login'))
 
 # ----- Views -----
+TOOLS_PER_PAGE = 50
+
 @app.route('/')
 @require_login
+@cache_page
 def index():
     q = request.args.get('q', '').strip()
     cat = request.args.get('cat', '').strip()
     holder = request.args.get('holder', '').strip()
 
-    query = Tool.query
+    cursor = request.args.get('cursor', type=parse_cursor)
+
+    # plain rows, not Tool objects: the cards only read a few columns
+    stmt = select(Tool.id, Tool.name, Tool.category, Tool.serial_no, Tool.photo_path, Tool.holder,
+                  Tool.checkout_date, Tool.created_at)
     if q:
-        like = f"%{q}%"
-        query = query.filter(or_(Tool.name.ilike(like), Tool.description.ilike(like), Tool.serial_no.ilike(like)))
+        if app.config['SEARCH_FTS']:
+            stmt = stmt.where(Tool.id.in_(search_ids(q)))
+        else:
+            like = f"%{q}%"
+            stmt = stmt.where(or_(Tool.name.ilike(like), Tool.description.ilike(like), Tool.serial_no.ilike(like)))
     if cat:
-        query = query.filter_by(category=cat)
+        stmt = stmt.where(Tool.category == cat)
     if holder:
-        query = query.filter_by(holder=holder)
+        stmt = stmt.where(Tool.holder == holder)
 
-    tools = query.order_by(Tool.created_at.desc()).all()
-    cats = [c[0] for c in db.session.query(Tool.category).distinct().all() if c[0]]
-    holders = [h[0] for h in db.session.query(Tool.holder).distinct().all() if h[0]]
-    return render_template('index.html', tools=tools, cats=cats, holders=holders, q=q, cat=cat, holder=holder)
+    # keyset paging: no OFFSET re-scan
+    rows = fetch_rows(keyset_selects(stmt, Tool.created_at, Tool.id, cursor), TOOLS_PER_PAGE + 1)
+    rows, first_url, next_url = keyset_page(rows, TOOLS_PER_PAGE, 'created_at', keep=('q', 'cat', 'holder'))
+    # (tool, detail URL) pairs: keeps url_for() out of the card loop in the template
+    detail_base = f"{request.script_root}/tool/"
+    tools = [(t, f"{detail_base}{t.id}") for t in rows]
+    cats, holders = get_facets()
+    return render_template('index.html', tools=tools, cats=cats, holders=holders, q=q, cat=cat, holder=holder,
+                           first_url=first_url, next_url=next_url)
 
 @app.route('/tool/new', methods=['GET', 'POST'])
 @require_login
@@ -121,32 +472,36 @@ def tool_new():
         category = request.form.get('category', '').strip()
         serial_no = request.form.get('serial_no', '').strip()
 
-        photo_file = request.files.get('photo')
-        photo_path = ""
-        if photo_file and allowed_file(photo_file.filename):
-            fname = secure_filename(photo_file.filename)
-            ts = datetime.utcnow().strftime('%Y%m%d%H%M%S')
-            fname = f"{ts}_{fname}"
-            save_path = UPLOAD_DIR / fname
-            photo_file.save(save_path)
-            photo_path = f"/uploads/{fname}"
+        photo_path = save_photo(request.files.get('photo')) or ""
 
         tool = Tool(name=name, description=description, category=category, serial_no=serial_no, photo_path=photo_path)
         db.session.add(tool)
-        db.session.commit()
-
+        db.session.flush()  # assigns tool.id; tool and its 'create' event go in one commit
         db.session.add(Event(tool_id=tool.id, type='create', note='Dodano narzędzie'))
         db.session.commit()
+        invalidate_caches()
         flash('Narzędzie dodane.', 'success')
         return redirect(url_for('tool_detail', tool_id=tool.id))
 
     return render_template('tool_new.html')
 
+TOOL_HISTORY_LIMIT = 200
+
 @app.route('/tool/<int:tool_id>')
 @require_login
 def tool_detail(tool_id):
-    tool = Tool.query.get_or_404(tool_id)
-    events = Event.query.filter_by(tool_id=tool.id).order_by(Event.when.desc()).all()
+    # exactly two statements; touching any column or relationship not loaded here raises
+    tool = db.one_or_404(
+        select(Tool)
+        .options(load_only(Tool.id, Tool.name, Tool.description, Tool.category, Tool.serial_no,
+                           Tool.photo_path, Tool.holder, Tool.checkout_date, raiseload=True),
+                 raiseload('*'))
+        .where(Tool.id == tool_id))
+    events = db.session.scalars(
+        select(Event).options(raiseload('*'))
+        .where(Event.tool_id == tool_id)
+        .order_by(Event.when.desc())
+        .limit(TOOL_HISTORY_LIMIT)).all()
     return render_template('tool_detail.html', tool=tool, events=events)
 
 @app.route('/tool/<int:tool_id>/edit', methods=['GET', 'POST'])
@@ -159,17 +514,13 @@ def tool_edit(tool_id):
         tool.category = request.form.get('category', tool.category)
         tool.serial_no = request.form.get('serial_no', tool.serial_no)
 
-        photo_file = request.files.get('photo')
-        if photo_file and allowed_file(photo_file.filename):
-            fname = secure_filename(photo_file.filename)
-            ts = datetime.utcnow().strftime('%Y%m%d%H%M%S')
-            fname = f"{ts}_{fname}"
-            save_path = UPLOAD_DIR / fname
-            photo_file.save(save_path)
-            tool.photo_path = f"/uploads/{fname}"
+        photo_path = save_photo(request.files.get('photo'))
+        if photo_path:
+            tool.photo_path = photo_path
 
         db.session.add(Event(tool_id=tool.id, type='edit', note='Edycja karty'))
         db.session.commit()
+        invalidate_caches()
         flash('Zapisano zmiany.', 'success')
         return redirect(url_for('tool_detail', tool_id=tool.id))
 
@@ -178,64 +529,115 @@ def tool_edit(tool_id):
 @app.route('/tool/<int:tool_id>/checkout', methods=['POST'])
 @require_login
 def tool_checkout(tool_id):
-    tool = Tool.query.get_or_404(tool_id)
     person = request.form.get('person', '').strip()
-    date = request.form.get('date', '').strip() or datetime.utcnow().strftime('%Y-%m-%d')
-    tool.holder = person
-    tool.checkout_date = date
-    db.session.add(Event(tool_id=tool.id, type='checkout', person=person, note=f"Wydano {date}"))
+    date = request.form.get('date', '').strip() or today_str()
+    # plain UPDATE + INSERT: no SELECT and no ORM object for the tool row
+    rows = db.session.execute(update(Tool).where(Tool.id == tool_id).values(holder=person, checkout_date=date)).rowcount
+    if not rows:
+        abort(404)
+    db.session.execute(insert(Event).values(tool_id=tool_id, type='checkout', person=person, note=f"Wydano {date}"))
     db.session.commit()
+    invalidate_caches()
     flash('Wydano narzędzie.', 'success')
-    return redirect(url_for('tool_detail', tool_id=tool.id))
+    return redirect(url_for('tool_detail', tool_id=tool_id))
 
 @app.route('/tool/<int:tool_id>/return', methods=['POST'])
 @require_login
 def tool_return(tool_id):
-    tool = Tool.query.get_or_404(tool_id)
-    person = tool.holder
-    tool.holder = ""
-    tool.checkout_date = ""
-    db.session.add(Event(tool_id=tool.id, type='return', person=person, note="Zwrot"))
+    row = db.session.execute(select(Tool.holder).where(Tool.id == tool_id)).first()
+    if row is None:
+        abort(404)
+    person = row.holder
+    db.session.execute(update(Tool).where(Tool.id == tool_id).values(holder="", checkout_date=""))
+    db.session.execute(insert(Event).values(tool_id=tool_id, type='return', person=person, note="Zwrot"))
     db.session.commit()
+    invalidate_caches()
     flash('Przyjęto zwrot.', 'success')
-    return redirect(url_for('tool_detail', tool_id=tool.id))
+    return redirect(url_for('tool_detail', tool_id=tool_id))
 
 # ----- API -----
 @app.route('/api/tools')
 @require_login
 def api_tools():
-    tools = Tool.query.order_by(Tool.created_at.desc()).all()
-    return jsonify([{
-        'id': t.id, 'name': t.name, 'description': t.description,
-        'category': t.category, 'serial_no': t.serial_no,
-        'photo_url': t.photo_path, 'holder': t.holder,
-        'checkout_date': t.checkout_date,
-        'detail_url': url_for('tool_detail', tool_id=t.id, _external=True)
-    } for t in tools])
+    """Tools as a JSON array, newest first, streamed row by row.
+
+    Optional keyset paging: ?after=<created_at>~<id> of the last item seen&limit=<n>.
+    A bare created_at is still accepted, but skips items sharing that timestamp.
+    """
+    after = request.args.get('after', type=parse_cursor)
+    limit = request.args.get('limit', type=int)
+    stmt = select(Tool.id, Tool.name, Tool.description, Tool.category, Tool.serial_no,
+                  Tool.photo_path, Tool.holder, Tool.checkout_date, Tool.created_at)
+    stmts = keyset_selects(stmt, Tool.created_at, Tool.id, after)
+    if not (limit and limit > 0):
+        limit = None
+    # url_for(_external=True) per row walks the URL map; the detail URL is a fixed prefix + id
+    base = f"{request.url_root}tool/"
+
+    def generate():
+        yield b'['
+        sep = b''
+        left = limit
+        for stmt in stmts:
+            if left is not None:
+                if left <= 0:
+                    break
+                stmt = stmt.limit(left)
+            for r in db.session.execute(stmt.execution_options(yield_per=500)):
+                if left is not None:
+                    left -= 1
+                yield sep + orjson.dumps({
+                    'id': r.id, 'name': r.name, 'description': r.description,
+                    'category': r.category, 'serial_no': r.serial_no,
+                    'photo_url': r.photo_path, 'holder': r.holder,
+                    'checkout_date': r.checkout_date, 'created_at': r.created_at,
+                    'detail_url': f"{base}{r.id}"
+                })
+                sep = b','
+        yield b']'
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
 # ----- Export CSV/Excel -----
+EXPORT_HEADER = ["id","name","category","serial_no","holder","checkout_date","created_at"]
+
+def export_rows():
+    """Export columns as Core rows, fetched in batches instead of materializing every Tool.
+
+    created_at is formatted by SQLite, so rows carry the final string instead of a datetime.
+    """
+    stmt = (select(Tool.id, Tool.name, Tool.category, Tool.serial_no, Tool.holder, Tool.checkout_date,
+                   func.strftime('%Y-%m-%d %H:%M', Tool.created_at).label('created_at_fmt'))
+            .order_by(Tool.created_at.desc()))
+    return db.session.execute(stmt.execution_options(yield_per=1000))
+
 @app.route('/export/csv')
 @require_login
 def export_csv():
-    tools = Tool.query.order_by(Tool.created_at.desc()).all()
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["id","name","category","serial_no","holder","checkout_date","created_at"])
-    for t in tools:
-        writer.writerow([t.id, t.name, t.category, t.serial_no, t.holder, t.checkout_date, t.created_at.strftime("%Y-%m-%d %H:%M")])
-    mem = io.BytesIO(output.getvalue().encode("utf-8-sig"))
-    return send_file(mem, as_attachment=True, download_name="tools_export.csv", mimetype="text/csv; charset=utf-8")
+    def generate():
+        output = io.StringIO()
+        writer = csv.writer(output)
+        output.write("\ufeff")  # BOM, so Excel opens the file as UTF-8
+        writer.writerow(EXPORT_HEADER)
+        for t in export_rows():
+            writer.writerow([t.id, t.name, t.category, t.serial_no, t.holder, t.checkout_date, t.created_at_fmt])
+            if output.tell() > 64 * 1024:
+                yield output.getvalue()
+                output.seek(0); output.truncate(0)
+        yield output.getvalue()
+    return Response(stream_with_context(generate()), mimetype="text/csv; charset=utf-8",
+                    headers={"Content-Disposition": "attachment; filename=tools_export.csv"})
 
 @app.route('/export/excel')
 @require_login
 def export_excel():
-    tools = Tool.query.order_by(Tool.created_at.desc()).all()
-    wb = Workbook(); ws = wb.active; ws.title = "Tools"
-    ws.append(["id","name","category","serial_no","holder","checkout_date","created_at"])
-    for t in tools:
-        ws.append([t.id, t.name, t.category, t.serial_no, t.holder, t.checkout_date, t.created_at.strftime("%Y-%m-%d %H:%M")])
-    mem = io.BytesIO(); wb.save(mem); mem.seek(0)
-    return send_file(mem, as_attachment=True, download_name="tools_export.xlsx",
+    # write-only mode streams rows out instead of keeping a cell object per value
+    wb = Workbook(write_only=True); ws = wb.create_sheet("Tools")
+    ws.append(EXPORT_HEADER)
+    for t in export_rows():
+        ws.append([t.id, t.name, t.category, t.serial_no, t.holder, t.checkout_date, t.created_at_fmt])
+    out = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE)
+    wb.save(out); out.seek(0)
+    return send_file(out, as_attachment=True, download_name="tools_export.xlsx",
                      mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
 # ----- Backup -----
@@ -249,7 +651,8 @@ def backup_now():
         # close connections and create consistent backup
         db.session.remove()
         db.engine.dispose()
-        with sqlite3.connect(DB_PATH) as src, sqlite3.connect(tmp_db) as dst:
+        # closing(): sqlite3's own context manager only commits, it never closes
+        with closing(sqlite3.connect(DB_PATH)) as src, closing(sqlite3.connect(tmp_db)) as dst:
             src.backup(dst)
 
         mem = io.BytesIO()
@@ -299,7 +702,8 @@ def restore_backup():
                             pass
 
                         # Copy contents (no file replace) – avoids WinError 5
-                        with sqlite3.connect(src_db) as src_conn, sqlite3.connect(DB_PATH) as dst_conn:
+                        # WAL mode refuses journal_mode changes while another connection is open
+                        with closing(sqlite3.connect(src_db)) as src_conn, closing(sqlite3.connect(DB_PATH)) as dst_conn:
                             dst_conn.execute('PRAGMA journal_mode=OFF;')
                             dst_conn.execute('PRAGMA synchronous=OFF;')
                             src_conn.backup(dst_conn)
@@ -307,6 +711,10 @@ def restore_backup():
                             dst_conn.execute('VACUUM;')
                             dst_conn.commit()
 
+                        # Older backups may predate the current indexes
+                        ensure_schema()
+                        invalidate_caches()
+
                     # Uploads (overwrite files)
                     for member in z.namelist():
                         if member.startswith('uploads/') and not member.endswith('/'):
@@ -430,11 +838,11 @@ TPL_INDEX = r"""{% extends 'base.html' %}
   </form>
 
   <div class="row g-3">
-    {% for t in tools %}
+    {% for t, detail_url in tools %}
       <div class="col-12 col-md-6 col-lg-4">
         <div class="card h-100 shadow-sm">
           {% if t.photo_path %}
-            <img src="{{ t.photo_path }}" class="card-img-top" alt="{{ t.name }}" style="object-fit:cover; height:200px;">
+            <img src="{{ t.photo_path|thumb }}" class="card-img-top" loading="lazy" alt="{{ t.name }}" style="object-fit:cover; height:200px;">
           {% endif %}
           <div class="card-body">
             <h5 class="card-title">{{ t.name }}</h5>
@@ -446,7 +854,7 @@ TPL_INDEX = r"""{% extends 'base.html' %}
             {% endif %}
           </div>
           <div class="card-footer d-flex gap-2">
-            <a class="btn btn-sm btn-outline-primary" href="{{ url_for('tool_detail', tool_id=t.id) }}">Otwórz</a>
+            <a class="btn btn-sm btn-outline-primary" href="{{ detail_url }}">Otwórz</a>
           </div>
         </div>
       </div>
@@ -454,6 +862,7 @@ TPL_INDEX = r"""{% extends 'base.html' %}
       <div class="col-12"><div class="alert alert-info">Brak wyników.</div></div>
     {% endfor %}
   </div>
+  {% include 'pager.html' %}
 {% endblock %}"""
 
 TPL_TOOL_NEW = r"""{% extends 'base.html' %}
@@ -549,7 +958,7 @@ TPL_TOOL_DETAIL = r"""{% extends 'base.html' %}
               </div>
               <div class="col-md-4">
                 <label class="form-label">Data pobrania</label>
-                <input class="form-control" type="date" name="date" value="{{ now().strftime('%Y-%m-%d') if now else '' }}">
+                <input class="form-control" type="date" name="date" value="{{ today() }}">
               </div>
               <div class="col-md-3 align-self-end">
                 <button class="btn btn-primary w-100">Wydaj</button>
@@ -609,10 +1018,10 @@ TPL_EVENTS = r"""{% extends 'base.html' %}
       <tbody>
         {% for row in rows %}
           <tr>
-            <td class="text-nowrap">{{ row.when.strftime('%Y-%m-%d %H:%M') }}</td>
+            <td class="text-nowrap">{{ row.when.strftime('%Y-%m-%d %H:%M') if row.when else '—' }}</td>
             <td class="text-capitalize">{{ row.type }}</td>
             <td>{{ row.person or '—' }}</td>
-            <td>{{ row.tool_name }}</td>
+            <td>{{ row.tool_name or 'ID %s' % row.tool_id }}</td>
             <td><a class="btn btn-sm btn-outline-secondary" href="{{ url_for('tool_detail', tool_id=row.tool_id) }}">Otwórz</a></td>
           </tr>
         {% else %}
@@ -621,8 +1030,17 @@ TPL_EVENTS = r"""{% extends 'base.html' %}
       </tbody>
     </table>
   </div>
+  {% include 'pager.html' %}
 {% endblock %}"""
 
+# "newest / older" links of the keyset-paged lists (first_url / next_url from keyset_page)
+TPL_PAGER = r"""{% if first_url or next_url %}
+  <div class="d-flex justify-content-between mt-3">
+    {% if first_url %}<a class="btn btn-sm btn-outline-secondary" href="{{ first_url }}">&larr; Najnowsze</a>{% else %}<span></span>{% endif %}
+    {% if next_url %}<a class="btn btn-sm btn-outline-secondary" href="{{ next_url }}">Starsze &rarr;</a>{% endif %}
+  </div>
+{% endif %}"""
+
 TPL_SCAN = r"""{% extends 'base.html' %}
 {% block content %}
   <h1 class="h5 mb-3">Skaner QR</h1>
@@ -631,9 +1049,10 @@ TPL_SCAN = r"""{% extends 'base.html' %}
   <div id="result" class="mt-3"></div>
   <script src="https://unpkg.com/html5-qrcode"></script>
   <script>
+    const HTTP_RE=/^https?:\/\//i, NUM_RE=/^\d+$/;
     function onScanSuccess(decodedText){
-      if(/^https?:\\/\\//i.test(decodedText)){window.location.href=decodedText;return;}
-      if(/^\\d+$/.test(decodedText)){window.location.href='/tool/'+decodedText;return;}
+      if(HTTP_RE.test(decodedText)){window.location.href=decodedText;return;}
+      if(NUM_RE.test(decodedText)){window.location.href='/tool/'+decodedText;return;}
       document.getElementById('result').innerHTML='<div class="alert alert-warning">Nieznany format: '+decodedText+'</div>';
     }
     function onScanFailure(error){}
@@ -680,22 +1099,36 @@ def register_templates(app):
         'tool_edit.html': TPL_TOOL_EDIT,
         'tool_detail.html': TPL_TOOL_DETAIL,
         'events.html': TPL_EVENTS,
+        'pager.html': TPL_PAGER,
         'scan.html': TPL_SCAN,
         'restore.html': TPL_RESTORE,
     })
+    # compiled bytecode is shared across workers/restarts; compile everything up front.
+    # Cache files are executed when loaded: without JINJA_CACHE_DIR, Jinja picks a per-user
+    # directory it creates with mode 0700 and checks ownership of.
+    cache_dir = os.environ.get("JINJA_CACHE_DIR")
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir) if cache_dir else FileSystemBytecodeCache()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
 register_templates(app)
 
 @app.context_processor
 def inject_now():
-    return dict(now=datetime.utcnow)
+    return dict(now=datetime.utcnow, today=today_str)
+
+EVENTS_PER_PAGE = 100
 
 @app.route('/events')
 @require_login
+@cache_page
 def events_listing():
-    events = Event.query.order_by(Event.when.desc()).all()
-    tool_names = {t.id: t.name for t in Tool.query.with_entities(Tool.id, Tool.name).all()}
-    rows = [dict(when=e.when, type=e.type, person=e.person, tool_id=e.tool_id, tool_name=tool_names.get(e.tool_id, f"ID {e.tool_id}")) for e in events]
-    return render_template('events.html', rows=rows)
+    cursor = request.args.get('cursor', type=parse_cursor)
+    # one joined query for just this page; outer join keeps events of tools that no longer exist
+    stmt = (select(Event.id, Event.when, Event.type, Event.person, Event.tool_id, Tool.name.label('tool_name'))
+            .outerjoin(Tool, Tool.id == Event.tool_id))
+    rows = fetch_rows(keyset_selects(stmt, Event.when, Event.id, cursor), EVENTS_PER_PAGE + 1)
+    rows, first_url, next_url = keyset_page(rows, EVENTS_PER_PAGE, 'when')
+    return render_template('events.html', rows=rows, first_url=first_url, next_url=next_url)
 
 @app.route('/healthz')
 def healthz():